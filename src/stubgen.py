@@ -56,15 +56,17 @@ specifically to simplify stub generation.
 import argparse
 import builtins
 import enum
+import functools
 from inspect import Signature, Parameter, signature, ismodule, getmembers
 import textwrap
 import importlib
 import importlib.machinery
 import importlib.util
+import os
 import types
 import typing
 from dataclasses import dataclass
-from typing import Dict, Sequence, List, Optional, Tuple, cast, Generator, Any, Callable, Union, Protocol, Literal
+from typing import Dict, Sequence, List, Set, Optional, Tuple, cast, Generator, Any, Callable, Union, Protocol, Literal
 from pathlib import Path
 import re
 import sys
@@ -84,16 +86,109 @@ if sys.version_info < (3, 11):
 else:
     typing_extensions = None
 
+if typing_extensions:
+    get_overloads = typing_extensions.get_overloads
+else:
+    get_overloads = typing.get_overloads
+
+# Module providing 'TypeAlias'
+if sys.version_info >= (3, 10, 0):
+    TYPE_ALIAS_MODULE = "typing"
+else:
+    TYPE_ALIAS_MODULE = "typing_extensions"
+
+# Classes of variadic type variables, and of all kinds of type variables
+TYPE_VAR_TUPLE_TYPES: Tuple[type, ...] = ()
+if sys.version_info >= (3, 11):
+    TYPE_VAR_TUPLE_TYPES += (typing.TypeVarTuple,)
+if typing_extensions is not None:
+    TYPE_VAR_TUPLE_TYPES += (typing_extensions.TypeVarTuple,)
+
+TYPE_VAR_TYPES: Tuple[type, ...] = (typing.TypeVar,) + TYPE_VAR_TUPLE_TYPES
+if typing_extensions is not None:
+    TYPE_VAR_TYPES += (typing_extensions.TypeVar,)
+
 # Exclude various standard elements found in modules, classes, etc.
-SKIP_LIST = [
+SKIP_LIST = frozenset((
     "__doc__", "__module__", "__name__", "__new__", "__builtins__",
     "__cached__", "__path__", "__version__", "__spec__", "__loader__",
     "__package__", "__nb_signature__", "__class_getitem__", "__orig_bases__",
     "__file__", "__dict__", "__weakref__", "__format__", "__nb_enum__",
     "__firstlineno__", "__static_attributes__", "__annotations__", "__annotate__"
-]
+))
 # fmt: on
 
+# Built-in function types recognized by ``StubGen.is_function()``
+FUNCTION_TYPES = (
+    types.FunctionType, types.BuiltinFunctionType, types.BuiltinMethodType,
+    types.WrapperDescriptorType, staticmethod, classmethod
+)
+
+# Names of the nanobind function types (their ``__module__`` is "nanobind")
+NB_FUNCTION_TYPES = frozenset(("nb_func", "nb_method"))
+
+# Types whose instances are rendered by ``StubGen.expr_str()`` using ``repr()``
+REPR_TYPES = (bool, int, type(None), type(builtins.Ellipsis))
+
+# Parameter kinds and the marker of absent annotations/defaults, bound once
+# for ``StubGen.signature_str()`` and ``StubGen.param_str()``
+POSITIONAL_ONLY = Parameter.POSITIONAL_ONLY
+VAR_POSITIONAL = Parameter.VAR_POSITIONAL
+KEYWORD_ONLY = Parameter.KEYWORD_ONLY
+VAR_KEYWORD = Parameter.VAR_KEYWORD
+EMPTY = Parameter.empty  # Same object as ``Signature.empty``
+
+# ---------- Regular expressions ----------
+
+# Placeholder for the default value of an argument in a nanobind signature.
+# '\=N' refers to a user-provided string, '\N' to the N-th default value.
+DEFAULT_ARG_RE = re.compile(r"\\(=?)(\d+)")
+
+# Negative lookbehind matching word boundaries except '.'
+SEP_BEFORE = r"(?<![\\B\.])"
+
+# Negative lookforward matching word boundaries except '.'
+SEP_AFTER = r"(?![\\B\.])"
+
+# Regexp matching a Python identifier
+IDENTIFIER = r"[^\d\W]\w*"
+
+# Precompiled RE that finds all type names that ``StubGen.simplify_types()``
+# may rewrite in a single pass. It matches either a nanobind nd-array
+# annotation (group 'ndarray') or a sequence of identifiers separated by
+# periods (group 'id_seq'). Earlier alternatives take precedence.
+TYPE_NAME_RE = re.compile(
+    "(?P<ndarray>"
+    + SEP_BEFORE
+    + r"(?:numpy\.ndarray|ndarray|torch\.Tensor)\[(?P<ndarray_args>[^\]]*)\])"
+    + "|(?P<id_seq>"
+    + SEP_BEFORE
+    + "(?P<mod_name>(?:"
+    + IDENTIFIER
+    + r"\.)+)(?P<cls_name>"
+    + IDENTIFIER
+    + r")\b"
+    + SEP_AFTER
+    + ")"
+)
+
+# Precompiled RE matching the (unquoted) dtype parameter of an nd-array
+NDARRAY_DTYPE_RE = re.compile(r"dtype=([\w]*)\b")
+
+# Precompiled RE detecting back-references in a pattern file query
+BACKREF_RE = re.compile(r"\\\d|\(\?P=|\(\?\(")
+
+# Types which moved from typing.* to collections.abc in Python 3.9
+if sys.version_info >= (3, 9, 0):
+    ABC_TYPES = frozenset((
+        "AsyncGenerator", "AsyncIterable", "AsyncIterator", "Awaitable", "Callable",
+        "Collection", "Container", "Coroutine", "Generator", "Hashable", "ItemsView",
+        "Iterable", "Iterator", "KeysView", "Mapping", "MappingView", "MutableMapping",
+        "MutableSequence", "MutableSet", "Sequence", "ValuesView"
+    ))
+else:
+    ABC_TYPES: typing.FrozenSet[str] = frozenset()
+
 # This type is used to track per-module imports (``import name as desired_name``)
 # during stub generation. The actual name in the stub is given by the value element.
 # (name, desired_as_name) -> actual_as_name
@@ -166,6 +261,35 @@ class ReplacePattern:
     matches: int
 
 
+def combine_patterns(patterns: List[ReplacePattern]) -> Optional[Pattern[str]]:
+    """
+    Merge the queries of a list of replacement patterns into a single regular
+    expression that matches whenever any of them does. This provides a fast
+    test to rule out that any pattern applies to a given name.
+
+    Returns ``None`` when the patterns cannot be merged safely, i.e., when they
+    use different flags or contain back-references to groups (whose numbering
+    would change in the combined expression).
+    """
+    if not patterns:
+        return None
+
+    flags = patterns[0].query.flags
+    for p in patterns:
+        if p.query.flags != flags or (
+            p.query.groups and BACKREF_RE.search(p.query.pattern)
+        ):
+            return None
+
+    try:
+        return re.compile(
+            "|".join(f"(?:{p.query.pattern})" for p in patterns), flags
+        )
+    except re.error:
+        # E.g., the same group name is used by several queries
+        return None
+
+
 class StubGen:
     def __init__(
         self,
@@ -204,6 +328,9 @@ class StubGen:
         # Replacement patterns as produced by ``load_pattern_file()`` below
         self.patterns = patterns
 
+        # Single regular expression matching any of the pattern queries
+        self.patterns_re = combine_patterns(patterns)
+
         # Set this to ``True`` if output to stdout is unacceptable
         self.quiet = quiet
 
@@ -215,11 +342,12 @@ class StubGen:
         # Current depth / indentation level
         self.depth = 0
 
-        # Output will be appended to this string
-        self.output = ""
+        # Output fragments are appended to this list and joined in ``get()``
+        self.output_buf: List[str] = []
 
-        # A stack to avoid infinite recursion
-        self.stack: List[object] = []
+        # Identities (``id()``) of the objects currently being processed by
+        # ``put()``. They are used to detect cycles and avoid infinite recursion.
+        self.stack_ids: Set[int] = set()
 
         # An identifier associated with the top element of the stack
         self.prefix = module.__name__
@@ -228,54 +356,37 @@ class StubGen:
         # Maps package_name -> ((name, desired_as_name) -> actual_as_name)
         self.imports: PackagesDict = {}
 
-        # ---------- Regular expressions ----------
+        # Cache of modules looked up by ``resolve_module()`` (``None`` when the
+        # import failed)
+        self.modules: Dict[str, Optional[types.ModuleType]] = {}
 
-        # Negative lookbehind matching word boundaries except '.'
-        sep_before = r"(?<![\\B\.])"
+        # Cache of signatures computed by ``signature()``, indexed by ``id()``.
+        # The function is also stored to ensure that its ``id()`` remains valid.
+        self.signatures: Dict[int, Tuple[Any, Signature]] = {}
 
-        # Negative lookforward matching word boundaries except '.'
-        sep_after = r"(?![\\B\.])"
+        # Cache of strings produced by ``type_str()``, indexed by ``id()``. The
+        # type object is also stored to ensure that its ``id()`` remains valid.
+        self.type_strs: Dict[int, Tuple[Any, str]] = {}
 
-        # Regexp matching a Python identifier
-        identifier = r"[^\d\W]\w*"
-
-        # Precompile RE a sequence of identifiers separated by periods
-        self.id_seq = re.compile(
-            sep_before
-            + "((?:"
-            + identifier
-            + r"\.)+)("
-            + identifier
-            + r")\b"
-            + sep_after
-        )
-
-        # Precompile RE to extract nanobind nd-arrays
-        self.ndarray_re = re.compile(
-            sep_before + r"(numpy\.ndarray|ndarray|torch\.Tensor)\[([^\]]*)\]"
-        )
-
-        # Types which moved from typing.* to collections.abc in Python 3.9
-        self.abc_re = re.compile(
-            'typing.(AsyncGenerator|AsyncIterable|AsyncIterator|Awaitable|Callable|'
-            'Collection|Container|Coroutine|Generator|Hashable|ItemsView|'
-            'Iterable|Iterator|KeysView|Mapping|MappingView|MutableMapping|'
-            'MutableSequence|MutableSet|Sequence|ValuesView)'
-        )
+    @property
+    def output(self) -> str:
+        """The stub contents generated so far (excluding imports)"""
+        return "".join(self.output_buf)
 
     def write(self, s: str) -> None:
         """Append raw characters to the output"""
-        self.output += s
+        self.output_buf.append(s)
 
     def write_ln(self, line: str) -> None:
         """Append an indented line"""
         if len(line) != 0 and not line.isspace():
-            self.output += "    " * self.depth + line
-        self.output += "\n"
+            self.output_buf.append("    " * self.depth + line + "\n")
+        else:
+            self.output_buf.append("\n")
 
     def write_par(self, line: str) -> None:
         """Append an indented paragraph"""
-        self.output += textwrap.indent(line, "    " * self.depth)
+        self.output_buf.append(textwrap.indent(line, "    " * self.depth))
 
     def put_docstr(self, docstr: str) -> None:
         """Append an indented single or multi-line docstring"""
@@ -295,7 +406,7 @@ class StubGen:
         The ``put_nb_func()`` repeatedly calls this method to render the
         individual method overloads.
         """
-        sig_str, docstr, start = cast(str, sig[0]), cast(str, sig[1]), 0
+        sig_str, docstr = cast(str, sig[0]), cast(str, sig[1])
 
         # Label anonymous functions
         if sig_str.startswith("def (") and name is not None:
@@ -308,29 +419,24 @@ class StubGen:
         # Substitute in string versions of the default arguments
         default_args = sig[2]
         if default_args:
-            for index, arg in enumerate(default_args):
-                pos = -1
-                pattern = None
-                arg_str = None
+            placeholders = DEFAULT_ARG_RE.finditer(sig_str)
+            pieces: List[str] = []
+            start = 0
 
-                # First, handle the case where the user overrode the default value signature
-                if isinstance(arg, str):
-                    pattern = f"\\={index}"
-                    pos = sig_str.find(pattern, start)
-                    if pos >= 0:
-                        arg_str = arg
-
-                # General case
-                if pos < 0:
-                    pattern = f"\\{index}"
-                    pos = sig_str.find(pattern, start)
-
-                if pos < 0:
+            for index, arg in enumerate(default_args):
+                # Skip other backslash-digit sequences, e.g. within annotations
+                for m in placeholders:
+                    if int(m.group(2)) == index:
+                        break
+                else:
                     raise Exception(
                         "Could not locate default argument in function signature"
                     )
 
-                if not arg_str:
+                # First, handle the case where the user overrode the default value signature
+                if m.group(1) and isinstance(arg, str) and arg:
+                    arg_str = arg
+                else:
                     # Call expr_str to convert the default value to a string.
                     # Abbreviate with '...' if it is too long.
                     expr = self.expr_str(arg, abbrev=True)
@@ -340,22 +446,23 @@ class StubGen:
                     "\n" not in arg_str
                 ), "Default argument string may not contain newlines."
 
-                assert pattern is not None
-                sig_str = sig_str[:pos] + arg_str + sig_str[pos + len(pattern) :]
-                start = pos + len(arg_str)
+                pieces.append(sig_str[start : m.start()])
+                pieces.append(arg_str)
+                start = m.end()
+
+            pieces.append(sig_str[start:])
+            sig_str = "".join(pieces)
 
         if type(fn).__name__ == "nb_func" and self.depth > 0:
             self.write_ln("@staticmethod")
 
         if not docstr or not self.include_docstrings:
-            for s in sig_str.split("\n"):
+            for s in (sig_str + ": ...").split("\n"):
                 self.write_ln(s)
-            self.output = self.output[:-1] + ": ...\n"
         else:
             docstr = textwrap.dedent(docstr)
-            for s in sig_str.split("\n"):
+            for s in (sig_str + ":").split("\n"):
                 self.write_ln(s)
-            self.output = self.output[:-1] + ":\n"
             self.depth += 1
             self.put_docstr(docstr)
             self.depth -= 1
@@ -414,10 +521,7 @@ class StubGen:
 
         overloads: Sequence[Callable[..., Any]] = []
         if hasattr(fn, "__module__"):
-            if typing_extensions:
-                overloads = typing_extensions.get_overloads(fn)
-            else:
-                overloads = typing.get_overloads(fn)
+            overloads = get_overloads(fn)
 
         if not overloads:
             overloads = [fn]
@@ -427,7 +531,7 @@ class StubGen:
                 overload = self.import_object("typing", "overload")
                 self.write_ln(f"@{overload}")
 
-            sig_str = f"{name}{self.signature_str(signature(fno))}"
+            sig_str = f"{name}{self.signature_str(self.signature(fno))}"
 
             # Potentially copy docstring from the implementation function
             docstr = fno.__doc__
@@ -443,6 +547,15 @@ class StubGen:
                 self.depth -= 1
             self.write("\n")
 
+    def signature(self, fn: Callable[..., Any]) -> Signature:
+        """Return ``inspect.signature(fn)``, caching the result per function"""
+        cached = self.signatures.get(id(fn))
+        if cached is not None and cached[0] is fn:
+            return cached[1]
+        sig = signature(fn)
+        self.signatures[id(fn)] = (fn, sig)
+        return sig
+
     def put_property(self, prop: property, name: Optional[str]):
         """Append a Python 'property' object"""
         fget, fset = prop.fget, prop.fset
@@ -479,49 +592,39 @@ class StubGen:
 
             if same_module:
                 # This is an alias of a type in the same module or same top-level module
-                if sys.version_info >= (3, 10, 0):
-                    alias_tp = self.import_object("typing", "TypeAlias")
-                else:
-                    alias_tp = self.import_object("typing_extensions", "TypeAlias")
+                alias_tp = self.import_object(TYPE_ALIAS_MODULE, "TypeAlias")
                 self.write_ln(f"{name}: {alias_tp} = {tp.__qualname__}\n")
             elif self.include_external_imports or (same_toplevel_module and self.include_internal_imports):
                 # Import from a different module
                 self.put_value(tp, name)
         else:
             docstr = tp.__doc__
-            tp_dict = dict(tp.__dict__)
-            tp_bases: Union[List[str], Tuple[Any, ...], None] = None
+            tp_dict = tp.__dict__
 
-            if "__nb_signature__" in tp.__dict__:
+            if "__nb_signature__" in tp_dict:
                 # Types with a custom signature override
-                for s in tp.__nb_signature__.split("\n"):
+                for s in (tp.__nb_signature__ + ":").split("\n"):
                     self.write_ln(self.simplify_types(s))
-                self.output = self.output[:-1] + ":\n"
             else:
-                self.write_ln(f"class {tp_name}:")
+                tp_bases: Optional[Tuple[Any, ...]] = getattr(tp, "__orig_bases__", None)
                 if tp_bases is None:
-                    tp_bases = getattr(tp, "__orig_bases__", None)
-                    if tp_bases is None:
-                        tp_bases = tp.__bases__
-                    tp_bases = [self.type_str(base) for base in tp_bases]
-
-                if tp_bases != ["object"]:
-                    self.output = self.output[:-2] + "("
-                    for i, base in enumerate(tp_bases):
-                        if i:
-                            self.write(", ")
-                        self.write(base)
-                    self.write("):\n")
+                    tp_bases = tp.__bases__
+                bases = [self.type_str(base) for base in tp_bases]
+
+                if bases != ["object"]:
+                    self.write_ln(f"class {tp_name}({', '.join(bases)}):")
+                else:
+                    self.write_ln(f"class {tp_name}:")
 
             self.depth += 1
-            output_len = len(self.output)
+            output_len = len(self.output_buf)
             if docstr and self.include_docstrings:
                 self.put_docstr(docstr)
                 if len(tp_dict):
                     self.write("\n")
             for k, v in tp_dict.items():
                 self.put(v, k, tp)
-            if output_len == len(self.output):
+            if output_len == len(self.output_buf):
                 self.write_ln("pass\n")
             self.depth -= 1
 
@@ -531,12 +634,8 @@ class StubGen:
         by Python, or if it is a nanobind ``nb_func``.
         """
         return (
-            issubclass(tp, types.FunctionType)
-            or issubclass(tp, types.BuiltinFunctionType)
-            or issubclass(tp, types.BuiltinMethodType)
-            or issubclass(tp, types.WrapperDescriptorType)
-            or issubclass(tp, staticmethod)
-            or issubclass(tp, classmethod)
+            tp in FUNCTION_TYPES
+            or issubclass(tp, FUNCTION_TYPES)
             or (tp.__module__ == "nanobind" and tp.__name__ == "nb_func")
         )
 
@@ -549,16 +648,17 @@ class StubGen:
         long expressions to ``...``.
         """
         tp = type(value)
+        tp_mod = tp.__module__
 
         # Ignore module imports of non-type values like 'from typing import Optional'
         if (
             not self.include_external_imports
-            and tp.__module__ == "typing"
+            and tp_mod == "typing"
             and str(value) == f"typing.{name}"
         ):
             return
 
-        if tp.__module__ == '__future__':
+        if tp_mod == '__future__':
             return
 
         if isinstance(parent, type) and issubclass(tp, parent):
@@ -567,7 +667,7 @@ class StubGen:
             if value.__doc__ and self.include_docstrings:
                 self.put_docstr(value.__doc__)
             self.write("\n")
-        elif self.is_function(tp) or isinstance(value, type):
+        elif isinstance(value, type) or self.is_function(tp):
             named_value = cast(NamedObject, value)
             same_toplevel_module = named_value.__module__.split(".")[0] == self.module.__name__.split(".")[0]
 
@@ -584,22 +684,14 @@ class StubGen:
             if self.is_type_var(tp):
                 types = ""
             elif typing.get_origin(value):
-                if sys.version_info >= (3, 10, 0):
-                    types = ": " + self.import_object("typing", "TypeAlias")
-                else:
-                    types = ": " + self.import_object("typing_extensions", "TypeAlias")
+                types = ": " + self.import_object(TYPE_ALIAS_MODULE, "TypeAlias")
             else:
                 types = f": {self.type_str(tp)}"
 
             self.write_ln(f"{name}{types} = {value_str}\n")
 
     def is_type_var(self, tp: type) -> bool:
-        return (issubclass(tp, typing.TypeVar)
-            or (sys.version_info >= (3, 11) and issubclass(tp, typing.TypeVarTuple))
-            or (typing_extensions is not None
-            and (
-                issubclass(tp, typing_extensions.TypeVar)
-                or issubclass(tp, typing_extensions.TypeVarTuple))))
+        return issubclass(tp, TYPE_VAR_TYPES)
 
     def simplify_types(self, s: str) -> str:
         """
@@ -625,26 +717,27 @@ class StubGen:
            changed to 'collections.abc' on newer Python versions)
         """
 
+        # Fast path: every rewrite involves a dotted name or an nd-array
+        if "." not in s and "ndarray[" not in s:
+            return s
+
         # Process nd-array type annotations so that MyPy accepts them
         def process_ndarray(m: Match[str]) -> str:
-            s = m.group(2)
+            s = m.group("ndarray_args")
 
             ndarray = self.import_object("numpy.typing", "ArrayLike")
             assert ndarray
-            s = re.sub(r"dtype=([\w]*)\b", r"dtype='\g<1>'", s)
+            if "dtype=" in s:
+                s = NDARRAY_DTYPE_RE.sub(r"dtype='\g<1>'", s)
             s = s.replace("*", "None")
 
             if s:
                 annotated = self.import_object("typing", "Annotated")
+                s = TYPE_NAME_RE.sub(process, s)
                 return f"{annotated}[{ndarray}, dict({s})]"
             else:
                 return ndarray
 
-        s = self.ndarray_re.sub(process_ndarray, s)
-
-        if sys.version_info >= (3, 9, 0):
-            s = self.abc_re.sub(r'collections.abc.\1', s)
-
         # Process other type names and add suitable import statements
         def process_general(m: Match[str]) -> str:
             def is_valid_module(module_name: str) -> bool:
@@ -653,7 +746,12 @@ class StubGen:
                 except (ModuleNotFoundError, ValueError):
                     return False
 
-            full_name, mod_name, cls_name = m.group(0), m.group(1)[:-1], m.group(2)
+            full_name = m.group(0)
+            mod_name, cls_name = m.group("mod_name")[:-1], m.group("cls_name")
+
+            if mod_name == "typing" and cls_name in ABC_TYPES:
+                mod_name = "collections.abc"
+                full_name = f"{mod_name}.{cls_name}"
 
             if mod_name == "builtins":
                 # Simplify builtins
@@ -682,9 +780,13 @@ class StubGen:
                 self.import_object(mod_name, None)
                 return full_name
 
-        s = self.id_seq.sub(process_general, s)
+        def process(m: Match[str]) -> str:
+            if m.lastgroup == "ndarray":
+                return process_ndarray(m)
+            else:
+                return process_general(m)
 
-        return s
+        return TYPE_NAME_RE.sub(process, s)
 
     def apply_pattern(self, query: str, value: object) -> bool:
         """
@@ -695,6 +797,10 @@ class StubGen:
         match: Optional[Match[str]] = None
         pattern: Optional[ReplacePattern] = None
 
+        # Quickly rule out names that don't match any pattern
+        if self.patterns_re is not None and not self.patterns_re.search(query):
+            return False
+
         for pattern in self.patterns:
             match = pattern.query.search(query)
             if match:
@@ -709,10 +815,7 @@ class StubGen:
                 # Docstring reference
                 tp = type(value)
                 doc: Optional[str] = None
-                if tp.__module__ == "nanobind" and tp.__name__ in (
-                    "nb_func",
-                    "nb_method",
-                ):
+                if tp.__module__ == "nanobind" and tp.__name__ in NB_FUNCTION_TYPES:
                     value = cast(NbFunction, value)
                     for tp_i in value.__nb_signature__:
                         doc = tp_i[1]
@@ -753,13 +856,14 @@ class StubGen:
 
     def put(self, value: object, name: Optional[str] = None, parent: Optional[object] = None) -> None:
         old_prefix = self.prefix
+        value_id = id(value)
 
-        if value in self.stack:
+        if value_id in self.stack_ids:
             # Avoid infinite recursion due to cycles
             return
 
         try:
-            self.stack.append(value)
+            self.stack_ids.add(value_id)
             self.prefix = self.prefix + (("." + name) if name else "")
 
             # Check if an entry in a provided pattern file matches
@@ -770,29 +874,32 @@ class StubGen:
             if name in SKIP_LIST:
                 return
 
-            is_type_alias = typing.get_origin(value) or (
-                isinstance(value, type)
-                and (value.__name__ != name or value.__module__ != self.module.__name__)
-            )
+            tp = type(value)
+            tp_mod, tp_name = tp.__module__, tp.__name__
+            is_type = issubclass(tp, type)
 
             # Ignore private members unless the user requests their inclusion
             if (
                 not self.include_private
                 and name
-                and not is_type_alias
                 and len(name) > 2
                 and (
                     (name[0] == "_" and name[1] != "_")
                     or (name[-1] == "_" and name[-2] != "_")
                 )
             ):
-                return
-
-            tp = type(value)
-            tp_mod, tp_name = tp.__module__, tp.__name__
+                # .. but keep type aliases that happen to have a private name
+                is_type_alias = typing.get_origin(value) or (
+                    is_type
+                    and (value.__name__ != name or value.__module__ != self.module.__name__)
+                )
+                if not is_type_alias:
+                    return
 
             if ismodule(value):
-                if len(self.stack) != 1:
+                # The set holds no duplicates, since 'put()' returns early on
+                # cycles. Its size is therefore the current recursion depth.
+                if len(self.stack_ids) != 1:
                     value_name_s = value.__name__.split(".")
                     module_name_s = self.module.__name__.split(".")
                     is_external = value_name_s[0] != module_name_s[0]
@@ -831,18 +938,25 @@ class StubGen:
                         if not self.quiet:
                             print(f'  - writing stub "{output_file}" ..')
 
-                        with open(output_file, "w", encoding='utf-8') as f:
-                            f.write(sg.get())
+                        output_file.write_bytes(sg.get().encode('utf-8'))
                     return
                 else:
                     self.apply_pattern(self.prefix + ".__prefix__", None)
-                    for name, child in getmembers(value):
+                    # Visit module members in alphabetical order. Modules
+                    # defining '__getattr__' or '__dir__' (PEP 562) can provide
+                    # members that are missing from their dictionary.
+                    members = vars(value)
+                    if "__getattr__" in members or "__dir__" in members:
+                        items = getmembers(value)
+                    else:
+                        items = sorted(members.items())
+                    for name, child in items:
                         self.put(child, name=name, parent=value)
                     self.apply_pattern(self.prefix + ".__suffix__", None)
             elif self.is_function(tp):
                 value = cast(NbFunction, value)
                 self.put_function(value, name, parent)
-            elif issubclass(tp, type):
+            elif is_type:
                 value = cast(NbType, value)
                 self.put_type(value, name)
             elif tp_mod == "nanobind":
@@ -864,7 +978,7 @@ class StubGen:
                 assert name is not None
                 self.put_value(value, name, parent)
         finally:
-            self.stack.pop()
+            self.stack_ids.discard(value_id)
             self.prefix = old_prefix
 
     def import_object(
@@ -890,15 +1004,13 @@ class StubGen:
             module_short = module
 
         # Query a cache of previously imported objects
-        imports_module: Optional[ImportDict] = self.imports.get(module_short, None)
-        if not imports_module:
-            imports_module = {}
-            self.imports[module_short] = imports_module
+        imports_module: Optional[ImportDict] = self.imports.get(module_short)
+        if imports_module is None:
+            imports_module = self.imports[module_short] = {}
 
         key = (name, as_name)
-        final_name = imports_module.get(key, None)
-        if final_name:
-            return final_name
+        if key in imports_module:
+            return imports_module[key] or ""
 
         # Cache miss, import the object
         final_name = as_name if as_name else name
@@ -907,22 +1019,15 @@ class StubGen:
         # avoid conflicts with an existing object of the same name
         if name and not as_name:
             test_name = name
-            while True:
-                # Accept the name if there are no conflicts
-                if not hasattr(self.module, test_name):
-                    break
+
+            # Accept the name if there are no conflicts
+            while hasattr(self.module, test_name):
                 value = getattr(self.module, test_name)
-                try:
-                    if module == ".":
-                        mod_o = self.module
-                    else:
-                        mod_o = importlib.import_module(module)
+                mod_o = self.resolve_module(module)
 
-                    # If there is a conflict, accept it if it refers to the same object
-                    if getattr(mod_o, name) is value:
-                        break
-                except ImportError:
-                    pass
+                # If there is a conflict, accept it if it refers to the same object
+                if mod_o is not None and getattr(mod_o, name) is value:
+                    break
 
                 # Prefix with an underscore
                 test_name = "_" + test_name
@@ -931,6 +1036,23 @@ class StubGen:
         imports_module[key] = final_name
         return final_name if final_name else ""
 
+    def resolve_module(self, module: str) -> Optional[types.ModuleType]:
+        """
+        Return the module object named ``module``, or ``None`` if it cannot be
+        imported. Results are cached for the lifetime of the stub generator.
+        """
+        if module == ".":
+            return self.module
+        if module in self.modules:
+            return self.modules[module]
+        mod_o: Optional[types.ModuleType]
+        try:
+            mod_o = importlib.import_module(module)
+        except ImportError:
+            mod_o = None
+        self.modules[module] = mod_o
+        return mod_o
+
     def expr_str(self, e: Any, abbrev: bool = True) -> Optional[str]:
         """
         Attempt to convert a value into valid Python syntax that regenerates
@@ -939,9 +1061,8 @@ class StubGen:
         complicated.
         """
         tp = type(e)
-        for t in [bool, int, type(None), type(builtins.Ellipsis)]:
-            if issubclass(tp, t):
-                return repr(e)
+        if tp in REPR_TYPES or issubclass(tp, REPR_TYPES):
+            return repr(e)
         if issubclass(tp, float):
             s = repr(e)
             if "inf" in s or "nan" in s:
@@ -954,8 +1075,7 @@ class StubGen:
             return f'"{e.__forward_arg__}"'
         elif issubclass(tp, enum.Enum):
             return self.type_str(tp) + '.' + e.name
-        elif (sys.version_info >= (3, 11) and issubclass(tp, typing.TypeVarTuple)) \
-            or (typing_extensions is not None and issubclass(tp, typing_extensions.TypeVarTuple)):
+        elif issubclass(tp, TYPE_VAR_TUPLE_TYPES):
             tv = self.import_object(tp.__module__, "TypeVarTuple")
             return f'{tv}("{e.__name__}")'
         elif issubclass(tp, typing.TypeVar):
@@ -978,32 +1098,33 @@ class StubGen:
             s = repr(e)
             if len(s) < self.max_expr_length or not abbrev:
                 return s
-        elif issubclass(tp, list) or issubclass(tp, tuple):
-            e = [self.expr_str(v, abbrev) for v in e]
-            if None in e:
-                return None
+        elif issubclass(tp, (list, tuple)):
+            items: List[str] = []
+            for v in e:
+                # Directly render elements that would be converted using repr()
+                v_str = repr(v) if type(v) in REPR_TYPES else self.expr_str(v, abbrev)
+                if v_str is None:
+                    return None
+                items.append(v_str)
             if issubclass(tp, list):
-                s = "[" + ", ".join(e) + "]"
+                s = "[" + ", ".join(items) + "]"
             else:
-                s = "(" + ", ".join(e) + ")"
+                s = "(" + ", ".join(items) + ")"
             if len(s) < self.max_expr_length or not abbrev:
                 return s
         elif issubclass(tp, dict):
-            e = [
-                (self.expr_str(k, abbrev), self.expr_str(v, abbrev))
-                for k, v in e.items()
-            ]
-            s = "{"
-            for i, (k, v) in enumerate(e):
-                if k is None or v is None:
+            items = []
+            for k, v in e.items():
+                k_str = repr(k) if type(k) in REPR_TYPES else self.expr_str(k, abbrev)
+                if k_str is None:
+                    return None
+                v_str = repr(v) if type(v) in REPR_TYPES else self.expr_str(v, abbrev)
+                if v_str is None:
                     return None
-                s += k + " : " + v
-                if i + 1 < len(e):
-                    s += ", "
-            s += "}"
+                items.append(k_str + " : " + v_str)
+            s = "{" + ", ".join(items) + "}"
             if len(s) < self.max_expr_length or not abbrev:
                 return s
-            pass
         return None
 
     def signature_str(self, s: Signature) -> str:
@@ -1016,15 +1137,15 @@ class StubGen:
         for param in s.parameters.values():
             kind = param.kind
 
-            if kind == Parameter.POSITIONAL_ONLY:
+            if kind is POSITIONAL_ONLY:
                 posonly_sep = True
             elif posonly_sep:
                 params.append("/")
                 posonly_sep = False
 
-            if kind == Parameter.VAR_POSITIONAL:
+            if kind is VAR_POSITIONAL:
                 kwonly_sep = False
-            elif kind == Parameter.KEYWORD_ONLY and kwonly_sep:
+            elif kind is KEYWORD_ONLY and kwonly_sep:
                 params.append("*")
                 kwonly_sep = False
             params.append(self.param_str(param))
@@ -1033,31 +1154,59 @@ class StubGen:
             params.append("/")
 
         result = f"({', '.join(params)})"
-        if s.return_annotation != Signature.empty:
+        if s.return_annotation is not EMPTY:
             result += " -> " + self.type_str(s.return_annotation)
         return result
 
     def param_str(self, p: Parameter) -> str:
-        result = ""
-        if p.kind == Parameter.VAR_POSITIONAL:
-            result += "*"
-        elif p.kind == Parameter.VAR_KEYWORD:
-            result += "**"
-        result += p.name
-        has_type = p.annotation != Parameter.empty
-        has_def = p.default != Parameter.empty
+        kind, annotation, default = p.kind, p.annotation, p.default
+        has_type = annotation is not EMPTY
+        has_def = default is not EMPTY
+
+        # Fragments of the result, concatenated once at the end
+        parts: List[str] = []
+        if kind is VAR_POSITIONAL:
+            parts.append("*")
+        elif kind is VAR_KEYWORD:
+            parts.append("**")
+        parts.append(p.name)
 
         if has_type:
-            result += ": " + self.type_str(p.annotation)
+            parts.append(": ")
+            parts.append(self.type_str(annotation))
         if has_def:
-            result += " = " if has_type else "="
-            p_default_str = self.expr_str(p.default)
+            parts.append(" = " if has_type else "=")
+            # Common defaults (None, bools, ints) can be rendered directly
+            if type(default) in REPR_TYPES:
+                p_default_str: Optional[str] = repr(default)
+            else:
+                p_default_str = self.expr_str(default)
             assert p_default_str
-            result += p_default_str
-        return result
+            parts.append(p_default_str)
+        return "".join(parts)
 
     def type_str(self, tp: Union[List[Any], Tuple[Any, ...], Dict[Any, Any], Any]) -> str:
         """Attempt to convert a type into a Python expression which reproduces it"""
+
+        # The same type objects are frequently repeated, consult the cache first
+        cached = self.type_strs.get(id(tp))
+        if cached is not None:
+            return cached[1]
+
+        if issubclass(type(tp), type):
+            # Actual classes (as opposed to generic aliases, which only
+            # pretend to be classes) don't need any of the checks below
+            if tp is types.ModuleType:
+                result = "types.ModuleType"
+            elif tp.__module__ == "builtins" and "." not in tp.__qualname__:
+                # Fast path, equivalent to simplifying "builtins.X" -> "X"
+                return "None" if tp is type(None) else tp.__qualname__
+            else:
+                result = tp.__module__ + "." + tp.__qualname__
+            result = self.simplify_types(result)
+            self.type_strs[id(tp)] = (tp, result)
+            return result
+
         origin, args = typing.get_origin(tp), typing.get_args(tp)
 
         if isinstance(tp, str):
@@ -1087,13 +1236,12 @@ class StubGen:
                 + ", ".join(args_gen)
                 + "]"
             )
-        elif tp is types.ModuleType:
-            result = "types.ModuleType"
-        elif isinstance(tp, type):
-            result = tp.__module__ + "." + tp.__qualname__
         else:
             result = repr(tp)
-        return self.simplify_types(result)
+
+        result = self.simplify_types(result)
+        self.type_strs[id(tp)] = (tp, result)
+        return result
 
     def check_party(self, module: str) -> Literal[0, 1, 2]:
         """
@@ -1120,25 +1268,29 @@ class StubGen:
 
     def get(self) -> str:
         """Generate the final stub output"""
-        s = ""
+        parts: List[str] = []
         last_party = None
 
-        for module in sorted(self.imports, key=lambda i: str(self.check_party(i)) + i):
-            imports = self.imports[module]
+        # Group imports by their source (stdlib, 3rd party, this package)
+        imports_sorted = sorted(
+            (self.check_party(module), module, imports)
+            for module, imports in self.imports.items()
+        )
+
+        for party, module, imports in imports_sorted:
             items: List[str] = []
-            party = self.check_party(module)
 
             if party != last_party:
                 if last_party is not None:
-                    s += "\n"
+                    parts.append("\n")
                 last_party = party
 
             for (k, v1), v2 in imports.items():
                 if k is None:
                     if v1 and v1 != module:
-                        s += f"import {module} as {v1}\n"
+                        parts.append(f"import {module} as {v1}\n")
                     elif v1 is None or (k, None) not in imports:
-                        s += f"import {module}\n"
+                        parts.append(f"import {module}\n")
                 else:
                     if k != v2 or v1:
                         items.append(f"{k} as {v2}")
@@ -1147,18 +1299,19 @@ class StubGen:
 
             items = sorted(items)
             if items:
-                items_v0 = ", ".join(items)
-                items_v0 = f"from {module} import {items_v0}\n"
-                items_v1 = "(\n    " + ",\n    ".join(items) + "\n)"
-                items_v1 = f"from {module} import {items_v1}\n"
-                s += items_v0 if len(items_v0) <= 70 else items_v1
+                line = f"from {module} import {', '.join(items)}\n"
+                if len(line) > 70:
+                    # Too long, switch to a multi-line import
+                    items_str = "(\n    " + ",\n    ".join(items) + "\n)"
+                    line = f"from {module} import {items_str}\n"
+                parts.append(line)
 
-        s += "\n\n"
+        parts.append("\n\n")
 
         # Append the main generated stub
-        s += self.output
+        parts.extend(self.output_buf)
 
-        return s.rstrip() + "\n"
+        return "".join(parts).rstrip() + "\n"
 
 def parse_options(args: List[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -1271,27 +1424,39 @@ def parse_options(args: List[str]) -> argparse.Namespace:
     return opt
 
 
+@functools.lru_cache(maxsize=1024)
+def compile_query(query: str) -> Pattern[str]:
+    """
+    Compile the regular expression of a pattern file entry. Compiled queries
+    are shared by repeated invocations within the same process, and they are
+    not evicted by unrelated uses of the ``re`` module's own cache.
+    """
+    return re.compile(query)
+
+
 def load_pattern_file(fname: str) -> List[ReplacePattern]:
     """
     Load a pattern file from disk and return a list of pattern instances that
     includes precompiled versions of all of the contained regular expressions.
     """
 
-    with open(fname, "r", encoding='utf-8') as f:
-        f_lines = f.readlines()
+    # read_text() already translated universal newlines. Don't use
+    # splitlines(), which also splits on form feeds and other separators.
+    f_lines = Path(fname).read_text(encoding='utf-8').split("\n")
+    if not f_lines[-1]:
+        f_lines.pop()
 
     patterns: List[ReplacePattern] = []
 
     def add_pattern(query: str, lines: List[str]):
-        # Exactly 1 empty line at the end
         while lines and (lines[-1].isspace() or len(lines[-1]) == 0):
             lines.pop()
-        lines.append("")
 
-        # Identify deletions (replacement by only whitespace)
-        if all((p.isspace() or len(p) == 0 for p in lines)):
-            lines = []
-        patterns.append(ReplacePattern(re.compile(query[:-1]), lines, 0))
+        # Exactly 1 empty line at the end. When nothing remains, the
+        # replacement consisted of only whitespace, which denotes a deletion
+        if lines:
+            lines.append("")
+        patterns.append(ReplacePattern(compile_query(query[:-1]), lines, 0))
 
     lines: List[str]
     lines, query, dedent = [], None, 0
@@ -1325,8 +1490,6 @@ def load_pattern_file(fname: str) -> List[ReplacePattern]:
 
 
 def main(args: Optional[List[str]] = None) -> None:
-    import sys
-
     # Ensure that the current directory is on the path
     if "" not in sys.path and "." not in sys.path:
         sys.path.insert(0, "")
@@ -1346,6 +1509,8 @@ def main(args: Optional[List[str]] = None) -> None:
     for i in opt.imports:
         sys.path.insert(0, i)
 
+    ext_loader = importlib.machinery.ExtensionFileLoader
+
     for i, mod in enumerate(opt.modules):
         if not opt.quiet:
             if i > 0:
@@ -1355,7 +1520,7 @@ def main(args: Optional[List[str]] = None) -> None:
         mod_imported = importlib.import_module(mod)
 
         if opt.output_file:
-            file = Path(opt.output_file)
+            file_s = opt.output_file
         else:
             file_s = getattr(mod_imported, "__file__", None)
             if file_s is None:
@@ -1365,22 +1530,21 @@ def main(args: Optional[List[str]] = None) -> None:
                     "stub. You must specify the -o parameter to provide "
                     "the name of an output file."
                 )
-            file = Path(str(file_s))
+            dir_s, name_s = os.path.split(str(file_s))
 
-            ext_loader = importlib.machinery.ExtensionFileLoader
             if isinstance(mod_imported.__loader__, ext_loader):
                 # Splitting on "." (module nesting qualifier) handles the case
                 # of invoking stubgen on a module that's not in the current
                 # working directory - in that case, we still only want the Python
                 # module name as the stub file name, not the whole source tree
                 # hierarchy.
-                modname = mod_imported.__name__.split(".")[-1]
-                file = file.with_name(modname)
-            file = file.with_suffix(".pyi")
+                name_s = mod_imported.__name__.split(".")[-1]
+            name_s = os.path.splitext(name_s)[0] + ".pyi"
 
-            if opt.output_dir:
-                file = Path(opt.output_dir, file.name)
+            file_s = os.path.join(opt.output_dir or dir_s, name_s)
 
+        # Work with plain strings above, only create a single 'Path' here
+        file = Path(file_s)
         file.parents[0].mkdir(parents=True, exist_ok=True)
 
         sg = StubGen(
@@ -1404,10 +1568,9 @@ def main(args: Optional[List[str]] = None) -> None:
                 if p.matches != 0:
                     total_matches += p.matches
                     continue
-                rule_str = str(p.query)
-                if "re.compile" in rule_str:
-                    rule_str = rule_str.replace("re.compile(", "")[:-1]
                 if not opt.quiet:
+                    # Strip the "re.compile(...)" wrapper of the pattern's repr
+                    rule_str = str(p.query)[len("re.compile("):-1]
                     print(f"  - warning: rule {rule_str} did not match any elements.")
             if not opt.quiet:
                 print(f"  - applied {total_matches} patterns.")
@@ -1415,8 +1578,7 @@ def main(args: Optional[List[str]] = None) -> None:
         if not opt.quiet:
             print(f'  - writing stub "{file}" ..')
 
-        with open(file, "w", encoding='utf-8') as f:
-            f.write(sg.get())
+        file.write_bytes(sg.get().encode('utf-8'))
 
     if opt.marker_file:
         if not opt.quiet:
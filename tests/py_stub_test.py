@@ -66,3 +66,14 @@ class AClass:
 
     def overloaded_2(self, x):
         "docstr 3"
+
+# Module-level __getattr__/__dir__ (PEP 562) providing a lazily created member
+def __getattr__(name):
+    if name == "lazy_f":
+        def lazy_f(x: int) -> int:
+            return x
+        return lazy_f
+    raise AttributeError(name)
+
+def __dir__():
+    return [n for n in globals() if n not in ("__getattr__", "__dir__")] + ["lazy_f"]
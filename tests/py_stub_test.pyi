@@ -46,3 +46,5 @@ def f2(a=(3, (4, 5)), /, b=(1, 2), *, c=4):
 def f3(*args, **kwargs): ...
 
 def f4() -> Callable[[T], T]: ...
+
+def lazy_f(x: int) -> int: ...
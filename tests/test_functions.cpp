@@ -84,6 +84,27 @@ template <> struct nb::detail::type_caster<numeric_string> {
     }
 };
 
+// Integer whose type annotation contains a backslash-digit sequence, which
+// stubgen must not mistake for a default argument placeholder
+struct annotated_int {
+    int value;
+};
+
+template <> struct nb::detail::type_caster<annotated_int> {
+    NB_TYPE_CASTER(annotated_int, const_name("typing.Annotated[int, '\\5']"))
+
+    bool from_python(handle h, uint8_t flags, cleanup_list* cleanup) noexcept {
+        make_caster<int> int_caster;
+        if (!int_caster.from_python(h, flags, cleanup))
+            return false;
+        value.value = int_caster.operator cast_t<int>();
+        return true;
+    }
+    static handle from_cpp(annotated_int, rv_policy, handle) noexcept {
+        return nullptr;
+    }
+};
+
 int test_31(int i) noexcept { return i; }
 
 NB_MODULE(test_functions_ext, m) {
@@ -408,6 +429,11 @@ NB_MODULE(test_functions_ext, m) {
 
     m.def("test_any", [](nb::any a) { return a; } );
 
+    // Default argument following a backslash-digit sequence in an annotation
+    m.def("test_annotated_default",
+          [](annotated_int x, int y) { return x.value + y; },
+          "x"_a, "y"_a = 1);
+
     m.def("test_wrappers_list", []{
         nb::list l1, l2;
         l1.append(1);
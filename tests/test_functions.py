@@ -750,3 +750,7 @@ def test51_isinstance():
     assert not t.isinstance_(3, bool)
     with pytest.raises(TypeError):
         t.isinstance_(3, 7)
+
+def test52_annotated_default():
+    assert t.test_annotated_default(2) == 3
+    assert t.test_annotated_default(2, 3) == 5